@@ -1,15 +1,20 @@
-import json
 from enum import StrEnum
+from functools import lru_cache
 import logging.handlers
-from typing import Union, Optional, Dict
+from typing import Union, Optional, Dict, List, Tuple, Callable, NamedTuple
 
 import websocket
-import datetime
 import time
+import random
 import sys
+import socket
+import signal
+import threading
+import queue
+import atexit
 import requests
+import orjson
 from decouple import config
-import rich
 import paho.mqtt.client as paho
 
 # account specific values
@@ -20,11 +25,49 @@ API_SECRET = config("API_SECRET")
 AUTHENTICATION_HOST = 'https://api.authentication.husqvarnagroup.dev'
 SMART_HOST = 'https://api.smart.gardena.dev'
 
+# raw markers for spotting websocket messages with location data, these are dropped without being parsed
+TYPE_MARKER = '"type":'
+LOCATION_TYPE = '"LOCATION"'
+
 logger: logging.Logger = logging.getLogger("gardena-mower")
 
+# MQTT topics are TOPIC_PREFIX + serial + "/" + name, commands are received on the COMMAND_TOPIC_SUFFIX topic
+TOPIC_PREFIX = "gardena/mower/"
+COMMAND_TOPIC_SUFFIX = "/command"
+
+# delays in seconds before reconnecting the websocket, grows with jitter while setting it up keeps failing
+WEBSOCKET_RECONNECT_DELAY = 10
+WEBSOCKET_MAX_RECONNECT_DELAY = 300
+
+# seconds to wait for queued websocket messages to be handled after the connection closes
+WORKER_STOP_TIMEOUT = 5
+
 auth_token: Optional[str] = None
 service_id: Optional[str] = None
 
+# the running websocket and an event that stops the reconnect loop
+websocket_app: Optional[websocket.WebSocketApp] = None
+stop_event = threading.Event()
+
+# content type used for all JSON:API requests to the smart system API
+JSON_API_HEADERS = {"Content-Type": "application/vnd.api+json"}
+
+
+class SmartSystemAuth(requests.auth.AuthBase):
+    """Adds the API key and the current bearer token to requests to the smart system API. The token is
+    read when the request is sent, so a new token does not require any headers to be rebuilt."""
+
+    def __call__(self, r: requests.PreparedRequest) -> requests.PreparedRequest:
+        r.headers["x-api-key"] = API_KEY
+        r.headers["Authorization"] = "Bearer " + auth_token
+        return r
+
+
+# shared HTTP session, keeps the TLS connections to the Gardena hosts alive between calls
+http_session: requests.Session = requests.Session()
+http_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=4))
+smart_auth = SmartSystemAuth()
+
 
 class MoverActivity(StrEnum):
     unknown = "UNKNOWN"
@@ -63,7 +106,17 @@ class RfLinkState(StrEnum):
     offline = "OFFLINE"
 
 
+# lookup tables from the raw API values to the enum members, avoids raising ValueError for unknown values
+ACTIVITY_MAP: Dict[str, MoverActivity] = {member.value: member for member in MoverActivity}
+ERROR_MAP: Dict[str, MoverError] = {member.value: member for member in MoverError}
+BATTERY_STATE_MAP: Dict[str, BatteryState] = {member.value: member for member in BatteryState}
+RF_LINK_STATE_MAP: Dict[str, RfLinkState] = {member.value: member for member in RfLinkState}
+
+
 class Mover:
+    __slots__ = ("name", "serial", "model_type", "state", "battery_level", "rf_link_level", "operating_hours",
+                 "activity", "battery_state", "rf_link_state", "last_error_code")
+
     def __init__(self):
         self.name = "UNKNOWN"
         self.serial = -1
@@ -84,16 +137,54 @@ class Mover:
         return f"[name: {self.name}: model: {self.model_type}, serial: {self.serial}, activity: {self.activity.name}, battery state: {self.battery_state.name}, battery: {self.battery_level}%, rf state: {self.rf_link_state.name}, rf level: {self.rf_link_level}]"
 
 
+@lru_cache
+def create_command_payload(command: str, seconds: Optional[int] = None) -> bytes:
+    """Returns the serialized body for a mower control command. The bodies are cached, so each distinct
+    command is only serialized once."""
+    attributes: Dict[str, Union[str, int]] = {"command": command}
+    if seconds is not None:
+        attributes["seconds"] = seconds
+
+    return orjson.dumps({
+        "data": {
+            "type": "MOWER_CONTROL",
+            "id": "random_id",
+            "attributes": attributes
+        }
+    })
+
+
+class MowerTopics(NamedTuple):
+    """The topics that the data for one mower is published to."""
+    battery: str
+    battery_state: str
+    activity: str
+    last_error: str
+    operating_hours: str
+
+    @classmethod
+    def for_serial(cls, serial: int) -> "MowerTopics":
+        return cls(*(f"{TOPIC_PREFIX}{serial}/{name}" for name in cls._fields))
+
+
 class MqttClient:
     FIRST_RECONNECT_DELAY = 1
     RECONNECT_RATE = 2
     MAX_RECONNECT_COUNT = 12
     MAX_RECONNECT_DELAY = 60
 
+    # TCP_CORK only exists on Linux, elsewhere batches are sent without corking
+    TCP_CORK: Optional[int] = getattr(socket, "TCP_CORK", None)
+    CORK_TIMEOUT = 1
+
     def __init__(self, broker_ip: str, broker_port: int):
         self.subscribe_topic = None
+        self.stopping = False
+
+        # last message published to each topic, unchanged values are not published again
+        self.last_published: Dict[str, Union[str, bytes, bytearray, int, float]] = {}
 
-        logger.info(f"connecting to MQTT broker at {broker_ip}:{broker_port}")
+        logger.info("connecting to MQTT broker at %s:%s", broker_ip, broker_port)
 
         self.client = paho.Client(callback_api_version=paho.CallbackAPIVersion.VERSION2, client_id="gardena")
 
@@ -116,59 +207,106 @@ class MqttClient:
 
         self.client.loop_start()
 
-    def publish(self, topic: str, message: Union[str, bytes, bytearray, int, float]):
+    def stop(self):
+        """Disconnects from the broker and stops the network thread."""
+        self.stopping = True
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def publish(self, topic: str, message: Union[str, bytes, bytearray, int, float]) -> paho.MQTTMessageInfo:
         """Publish the given message to the given topic."""
-        self.client.publish(topic=topic, payload=message, retain=True)
+        return self.client.publish(topic=topic, payload=message, retain=True)
+
+    def publish_multiple(self, messages: List[Tuple[str, Union[str, bytes, bytearray, int, float]]]):
+        """Publish a batch of (topic, message) pairs in one go. Messages that are unchanged since they were
+        last published are skipped, the broker already has them retained.
+
+        When more than one message is sent the socket is corked while the batch is written, so that the
+        packets go out in as few TCP segments as possible. Must not be called from a paho callback, as that
+        thread does the actual writing."""
+        changed = [(topic, message) for topic, message in messages if self.last_published.get(topic) != message]
+        if not changed:
+            return
+
+        # a single packet has nothing to be coalesced with
+        sock = self.client.socket() if len(changed) > 1 else None
+        corked = self.set_cork(sock, True)
+
+        try:
+            last_info: Optional[paho.MQTTMessageInfo] = None
+            for topic, message in changed:
+                info = self.publish(topic, message)
+                if info.rc == paho.MQTT_ERR_SUCCESS:
+                    self.last_published[topic] = message
+                    last_info = info
+
+            # the packets are written by the network thread, uncork only once the last one has been written
+            if corked and last_info is not None:
+                last_info.wait_for_publish(timeout=MqttClient.CORK_TIMEOUT)
+        finally:
+            # never leave the socket corked, that would delay every later packet
+            if corked:
+                self.set_cork(sock, False)
+
+    def set_cork(self, sock, cork: bool) -> bool:
+        """Sets or clears TCP_CORK on the broker socket. Returns True if the option was changed."""
+        if sock is None or MqttClient.TCP_CORK is None:
+            return False
+
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, MqttClient.TCP_CORK, 1 if cork else 0)
+            return True
+        except OSError as err:
+            logger.debug("failed to set TCP_CORK: %s", err)
+            return False
 
     def subscribe(self, serial):
         if self.subscribe_topic is not None:
             return
 
-        self.subscribe_topic = f"gardena/mower/{serial}/command"
+        self.subscribe_topic = f"{TOPIC_PREFIX}{serial}{COMMAND_TOPIC_SUFFIX}"
         self.client.subscribe(self.subscribe_topic)
 
     def on_connect(self, client, userdata, connect_flags, reason, properties):
         logger.info("connected ok to broker")
 
+        # the broker may have lost the retained messages, publish everything again
+        self.last_published.clear()
+
     def on_subscribe(self, client, userdata, mid, reason_codes, properties):
-        logger.info(f"subscribe ok to topic {self.subscribe_topic}")
+        logger.info("subscribe ok to topic %s", self.subscribe_topic)
 
     def on_message(self, client, userdata, message):
         topic = message.topic
         command = message.payload.decode("utf-8")
-        logger.debug(f"topic: {message.topic}, data: {command}")
+        logger.debug("topic: %s, data: %s", message.topic, command)
 
-        topic_parts = topic.split("/")
-        if len(topic_parts) != 4:
-            logger.error(f"invalid topic: {topic}")
+        if not topic.startswith(TOPIC_PREFIX) or not topic.endswith(COMMAND_TOPIC_SUFFIX):
+            logger.error("invalid topic: %s", topic)
             return
 
         try:
-            serial = int(topic_parts[2])
+            serial = int(topic[len(TOPIC_PREFIX):-len(COMMAND_TOPIC_SUFFIX)])
         except ValueError:
-            logger.error(f"invalid serial in topic: {topic}")
+            logger.error("invalid serial in topic: %s", topic)
+            return
+
+        logger.info("received command '%s' for mower %s", command, serial)
+
+        if (handler := MqttClient.COMMANDS.get(command)) is None:
+            logger.warning("unknown command '%s' for mower %s", command, serial)
             return
 
-        logger.info(f"received command '{command}' for mower {serial}")
-
-        if command == "park":
-            self.park_mover_until_next_task()
-        elif command == "park_until_further_notice":
-            self.park_mover_until_further_notice()
-        elif command == "automatic":
-            self.automatic_operation()
-        elif command == "start_1h":
-            self.start_mower(1)
-        elif command == "start_3h":
-            self.start_mower(3)
-        elif command == "start_6h":
-            self.start_mower(6)
+        handler(self)
 
     def on_disconnect(self, client, userdata, disconnect_flags, reason, properties):
-        logging.info(f"disconnected with result code: {reason}")
+        logging.info("disconnected with result code: %s", reason)
+        if self.stopping:
+            return
+
         reconnect_count, reconnect_delay = 0, MqttClient.FIRST_RECONNECT_DELAY
         while reconnect_count < MqttClient.MAX_RECONNECT_COUNT:
-            logging.info(f"reconnecting in {reconnect_delay} seconds")
+            logging.info("reconnecting in %.1f seconds", reconnect_delay)
             time.sleep(reconnect_delay)
 
             try:
@@ -176,92 +314,76 @@ class MqttClient:
                 logging.info("reconnected successfully!")
                 return
             except Exception as err:
-                logging.error(f"{err}. reconnect failed. Retrying")
+                logging.error("%s. reconnect failed. Retrying", err)
 
-            reconnect_delay *= MqttClient.RECONNECT_RATE
+            # decorrelated jitter, keeps clients from all reconnecting at the same time after a broker outage
+            reconnect_delay = random.uniform(MqttClient.FIRST_RECONNECT_DELAY, reconnect_delay * MqttClient.RECONNECT_RATE)
             reconnect_delay = min(reconnect_delay, MqttClient.MAX_RECONNECT_DELAY)
             reconnect_count += 1
 
-        logging.info(f"reconnect failed after {reconnect_count} attempts. Exiting...")
+        logging.info("reconnect failed after %s attempts. Exiting...", reconnect_count)
 
     def on_connect_fail(self, client, userdata):
         logger.error("failed to connect to broker")
 
     def automatic_operation(self):
-        data = {
-            "data": {
-                "type": "MOWER_CONTROL",
-                "id": "random_id",
-                "attributes": {
-                    "command": "START_DONT_OVERRIDE"
-                }
-            }
-        }
-
-        r = requests.put(f'{SMART_HOST}/v1/command/{service_id}', headers=self.create_headers(), json=data)
+        data = create_command_payload("START_DONT_OVERRIDE")
+        r = http_session.put(f'{SMART_HOST}/v1/command/{service_id}', headers=JSON_API_HEADERS, auth=smart_auth, data=data)
         if r.status_code != 202:
-            logger.error(f"failed to park mower, status code: {r.status_code}, {r.text}")
+            logger.error("failed to park mower, status code: %s, %s", r.status_code, r.text)
         else:
             logger.info("mower sent automatic operation command")
 
     def park_mover_until_next_task(self):
-        data = {
-            "data": {
-                "type": "MOWER_CONTROL",
-                "id": "random_id",
-                "attributes": {
-                    "command": "PARK_UNTIL_NEXT_TASK"
-                }
-            }
-        }
-
-        r = requests.put(f'{SMART_HOST}/v1/command/{service_id}', headers=self.create_headers(), json=data)
+        data = create_command_payload("PARK_UNTIL_NEXT_TASK")
+        r = http_session.put(f'{SMART_HOST}/v1/command/{service_id}', headers=JSON_API_HEADERS, auth=smart_auth, data=data)
         if r.status_code != 202:
-            logger.error(f"failed to park mower, status code: {r.status_code}, {r.text}")
+            logger.error("failed to park mower, status code: %s, %s", r.status_code, r.text)
         else:
             logger.info("mower sent park until next task command")
 
     def park_mover_until_further_notice(self):
-        data = {
-            "data": {
-                "type": "MOWER_CONTROL",
-                "id": "random_id",
-                "attributes": {
-                    "command": "PARK_UNTIL_FURTHER_NOTICE"
-                }
-            }
-        }
-
-        r = requests.put(f'{SMART_HOST}/v1/command/{service_id}', headers=self.create_headers(), json=data)
+        data = create_command_payload("PARK_UNTIL_FURTHER_NOTICE")
+        r = http_session.put(f'{SMART_HOST}/v1/command/{service_id}', headers=JSON_API_HEADERS, auth=smart_auth, data=data)
         if r.status_code != 202:
-            logger.error(f"failed to park mower, status code: {r.status_code}, {r.text}")
+            logger.error("failed to park mower, status code: %s, %s", r.status_code, r.text)
         else:
             logger.info("mower sent park until further notice command")
 
     def start_mower(self, hours: int):
-        data = {
-            "data": {
-                "type": "MOWER_CONTROL",
-                "id": "random_id",
-                "attributes": {
-                    "command": "START_SECONDS_TO_OVERRIDE",
-                    "seconds": hours * 3600,
-                }
-            }
-        }
-
-        r = requests.put(f'{SMART_HOST}/v1/command/{service_id}', headers=self.create_headers(), json=data)
+        data = create_command_payload("START_SECONDS_TO_OVERRIDE", hours * 3600)
+        r = http_session.put(f'{SMART_HOST}/v1/command/{service_id}', headers=JSON_API_HEADERS, auth=smart_auth, data=data)
         if r.status_code != 202:
-            logger.error(f"failed to park mower, status code: {r.status_code}, {r.text}")
+            logger.error("failed to park mower, status code: %s, %s", r.status_code, r.text)
         else:
-            logger.info(f"mower sent start command, moving {hours} h")
+            logger.info("mower sent start command, moving %s h", hours)
+
+    # commands received on the command topic and the method that handles each
+    COMMANDS: Dict[str, Callable[["MqttClient"], None]] = {
+        "park": park_mover_until_next_task,
+        "park_until_further_notice": park_mover_until_further_notice,
+        "automatic": automatic_operation,
+        "start_1h": lambda self: self.start_mower(1),
+        "start_3h": lambda self: self.start_mower(3),
+        "start_6h": lambda self: self.start_mower(6),
+    }
 
-    def create_headers(self) -> Dict[str, str]:
-        return {
-            "Content-Type": "application/vnd.api+json",
-            "x-api-key": API_KEY,
-            "Authorization": "Bearer " + auth_token
-        }
+
+def get_attribute_value(attributes, name, default):
+    """Returns the value of the named attribute in a websocket message, or the default if it is missing."""
+    attribute = attributes.get(name)
+    return attribute.get("value", default) if attribute else default
+
+
+def is_location_message(message: str) -> bool:
+    """Checks if the top level type in the raw message is LOCATION. Other messages refer to locations in
+    their relationships, so a type is only accepted if no nested object opens before it. Messages where
+    the top level type comes later are not matched and get parsed as usual."""
+    index = message.find(TYPE_MARKER)
+    if index == -1 or message.find("{", 1, index) != -1:
+        return False
+
+    return message.startswith(LOCATION_TYPE, index + len(TYPE_MARKER))
 
 
 class WebSocketClient:
@@ -270,65 +392,86 @@ class WebSocketClient:
         self.mover = mover
         self.broker = broker
         self.live = False
+        self.topics: Optional[MowerTopics] = None
+
+        # set once a COMMON message with the serial has arrived, nothing can be published before that
+        self.ready = False
+
+        # raw messages waiting to be handled by the worker thread, None stops the worker
+        self.queue: queue.Queue[Optional[Union[str, bytes]]] = queue.Queue()
+        self.worker: Optional[threading.Thread] = None
 
     def on_message(self, ws, message):
-        message = json.loads(message)
-        # rich.print(message)
+        """Queues the raw message for the worker thread, so that the websocket thread can get back to
+        reading while the message is parsed and published."""
+        if isinstance(message, str) and is_location_message(message):
+            return
+
+        self.queue.put(message)
 
-        if "type" in message and message["type"] == "MOWER" and "attributes" in message:
+    def process_messages(self):
+        """Worker thread, handles queued messages until stopped."""
+        while (message := self.queue.get()) is not None:
+            try:
+                self.handle_message(message)
+            except Exception:
+                logger.exception("failed to handle message")
+
+    def handle_message(self, message: Union[str, bytes]):
+        message = orjson.loads(message)
+        message_type = message.get("type")
+
+        if message_type == "MOWER" and "attributes" in message:
             attributes = message["attributes"]
-            self.mover.state = self.get_attribute_value(attributes, "state", "UNKNOWN")
-            self.mover.operating_hours = int(self.get_attribute_value(attributes, "operatingHours", "-1"))
-            activity_str = self.get_attribute_value(attributes, "activity", None)
-            last_error_code_str = self.get_attribute_value(attributes, "lastErrorCode", None)
+            self.mover.state = get_attribute_value(attributes, "state", "UNKNOWN")
+            self.mover.operating_hours = int(get_attribute_value(attributes, "operatingHours", "-1"))
+            activity_str = get_attribute_value(attributes, "activity", None)
+            last_error_code_str = get_attribute_value(attributes, "lastErrorCode", None)
 
             if activity_str is not None:
-                try:
-                    self.mover.activity = MoverActivity(activity_str)
-                except ValueError:
-                    print(f"**** unknown activity: {activity_str}")
-                    self.mover.activity = MoverActivity.unknown
+                self.mover.activity = ACTIVITY_MAP.get(activity_str, MoverActivity.unknown)
+                if self.mover.activity is MoverActivity.unknown and activity_str != MoverActivity.unknown:
+                    logger.error("unknown activity: %s", activity_str)
 
             if last_error_code_str is not None:
-                try:
-                    self.mover.last_error_code = MoverError(last_error_code_str)
-                except ValueError:
-                    print(f"**** unknown error code: {last_error_code_str}")
-                    self.mover.last_error_code = MoverError.unknown
+                self.mover.last_error_code = ERROR_MAP.get(last_error_code_str, MoverError.unknown)
+                if self.mover.last_error_code is MoverError.unknown and last_error_code_str != MoverError.unknown:
+                    logger.error("unknown error code: %s", last_error_code_str)
+
+            # the state is kept, but it is published along with the COMMON data once that arrives
+            if not self.ready:
+                return
 
-            logger.info(f"{self.mover}")
+            logger.info("%s", self.mover)
 
             # publish all data
             self.publish_mower_data()
 
-        elif "type" in message and message["type"] == "COMMON" and "attributes" in message:
+        elif message_type == "COMMON" and "attributes" in message:
             attributes = message["attributes"]
-            self.mover.name = self.get_attribute_value(attributes, "name", "UNKNOWN")
-            self.mover.serial = int(self.get_attribute_value(attributes, "serial", "-1"))
-            self.mover.model_type = self.get_attribute_value(attributes, "modelType", "UNKNOWN")
-            self.mover.battery_level = int(self.get_attribute_value(attributes, "batteryLevel", "-1"))
-            self.mover.rf_link_level = int(self.get_attribute_value(attributes, "rfLinkLevel", "-1"))
-            battery_state_str = self.get_attribute_value(attributes, "batteryState", "UNKNOWN")
-            rf_link_state_str = self.get_attribute_value(attributes, "rfLinkState", "UNKNOWN")
-
-            try:
-                self.mover.battery_state = BatteryState(battery_state_str)
-            except ValueError:
-                logger.error(f"unknown battery state: {battery_state_str}")
-                self.mover.battery_state = BatteryState.unknown
-
-            try:
-                self.mover.rf_link_state = RfLinkState(rf_link_state_str)
-            except ValueError:
-                logger.error(f"unknown rf link state: {rf_link_state_str}")
-                self.mover.rf_link_state = RfLinkState.unknown
+            self.mover.name = get_attribute_value(attributes, "name", "UNKNOWN")
+            self.mover.serial = int(get_attribute_value(attributes, "serial", "-1"))
+            self.ready = self.ready or self.mover.serial != -1
+            self.mover.model_type = get_attribute_value(attributes, "modelType", "UNKNOWN")
+            self.mover.battery_level = int(get_attribute_value(attributes, "batteryLevel", "-1"))
+            self.mover.rf_link_level = int(get_attribute_value(attributes, "rfLinkLevel", "-1"))
+            battery_state_str = get_attribute_value(attributes, "batteryState", "UNKNOWN")
+            rf_link_state_str = get_attribute_value(attributes, "rfLinkState", "UNKNOWN")
+
+            self.mover.battery_state = BATTERY_STATE_MAP.get(battery_state_str, BatteryState.unknown)
+            if self.mover.battery_state is BatteryState.unknown and battery_state_str != BatteryState.unknown:
+                logger.error("unknown battery state: %s", battery_state_str)
+
+            self.mover.rf_link_state = RF_LINK_STATE_MAP.get(rf_link_state_str, RfLinkState.unknown)
+            if self.mover.rf_link_state is RfLinkState.unknown and rf_link_state_str != RfLinkState.unknown:
+                logger.error("unknown rf link state: %s", rf_link_state_str)
 
             # publish all data
             self.publish_mower_data()
 
-            logger.info(f"{self.mover}")
+            logger.info("%s", self.mover)
 
-        elif message["type"] == "DEVICE":
+        elif message_type == "DEVICE":
             # we need the service id for the mower
             relationships = message["relationships"]
             services = relationships["services"]
@@ -336,59 +479,73 @@ class WebSocketClient:
                 if service["type"] == "MOWER":
                     global service_id
                     service_id = service["id"]
-                    logger.debug(f"mower service id: {service_id}")
+                    logger.debug("mower service id: %s", service_id)
 
-        elif message["type"] == "LOCATION":
+        elif message_type == "LOCATION":
             # we don't care about these
             pass
 
         else:
-            logger.warn(f"unhandled message: {message["type"]}")
-            rich.print(message)
+            logger.warning("unhandled message: type=%s payload=%s", message_type, message)
 
     def on_error(self, ws, error):
-        logger.error(f"error: {error}")
+        logger.error("error: %s", error)
 
     def on_close(self, ws, close_status_code, close_msg):
         self.live = False
 
         logger.debug("websocket closed")
         if close_status_code:
-            logger.debug(f"status code: {close_status_code}")
+            logger.debug("status code: %s", close_status_code)
         if close_msg:
-            logger.debug(f"status message: {close_msg}")
+            logger.debug("status message: %s", close_msg)
 
     def on_open(self, ws):
+        # a stop request that arrived just before the connection was opened
+        if stop_event.is_set():
+            ws.close()
+            return
+
         logger.info("connected ok")
         self.live = True
 
-    def get_attribute_value(self, attributes, name, default):
-        if name not in attributes:
-            return default
-
-        attribute = attributes[name]
+        self.worker = threading.Thread(target=self.process_messages, name="websocket-messages", daemon=True)
+        self.worker.start()
 
-        if "value" not in attribute:
-            return default
+    def stop_worker(self, timeout: float):
+        """Lets the worker thread finish the queued messages and waits for it to exit."""
+        if self.worker is None:
+            return
 
-        return attribute["value"]
+        self.queue.put(None)
+        self.worker.join(timeout)
+        if self.worker.is_alive():
+            logger.warning("message worker did not finish within %s seconds", timeout)
 
     def publish_mower_data(self):
-        if self.mover.serial == -1:
+        if not self.ready:
             return
 
         # let the MQTT client subscribe to topics
         self.broker.subscribe(self.mover.serial)
 
-        self.broker.publish(f"gardena/mower/{self.mover.serial}/battery", self.mover.battery_level)
-        self.broker.publish(f"gardena/mower/{self.mover.serial}/battery_state", self.mover.battery_state.name)
-        self.broker.publish(f"gardena/mower/{self.mover.serial}/activity", self.mover.activity.name)
-        self.broker.publish(f"gardena/mower/{self.mover.serial}/last_error", self.mover.last_error_code.name)
-        self.broker.publish(f"gardena/mower/{self.mover.serial}/operating_hours", self.mover.operating_hours)
+        # the serial does not change, so the topics are only built once
+        if self.topics is None:
+            self.topics = MowerTopics.for_serial(self.mover.serial)
+
+        topics = self.topics
+        self.broker.publish_multiple([
+            (topics.battery, self.mover.battery_level),
+            (topics.battery_state, self.mover.battery_state.name),
+            (topics.activity, self.mover.activity.name),
+            (topics.last_error, self.mover.last_error_code.name),
+            (topics.operating_hours, self.mover.operating_hours),
+        ])
 
 
 def init_logger():
-    """Sets up a rotating file logger and a console logger."""
+    """Sets up a rotating file logger and a console logger. The handlers run on a background listener
+    thread, so logging never blocks the websocket or MQTT threads on disk or console I/O."""
     logger.setLevel(logging.DEBUG)
 
     formatter = logging.Formatter('%(asctime)s %(name)s %(levelname)s %(message)s')
@@ -402,19 +559,25 @@ def init_logger():
     file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(formatter)
 
-    logger.addHandler(console_log_handler)
-    logger.addHandler(file_handler)
+    log_queue: queue.Queue[logging.LogRecord] = queue.Queue(-1)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    listener = logging.handlers.QueueListener(log_queue, console_log_handler, file_handler, respect_handler_level=True)
+    listener.start()
 
+    # flushes any queued records on exit
+    atexit.register(listener.stop)
 
-def init_websocket() -> Optional[websocket.WebSocketApp]:
+
+def init_websocket(client: WebSocketClient) -> Optional[websocket.WebSocketApp]:
     """Set up the websocket connection to Gardena's server."""
     logger.debug("setting up websocket")
 
     payload = {'grant_type': 'client_credentials', 'client_id': API_KEY, 'client_secret': API_SECRET}
 
-    r = requests.post(f'{AUTHENTICATION_HOST}/v1/oauth2/token', data=payload)
+    r = http_session.post(f'{AUTHENTICATION_HOST}/v1/oauth2/token', data=payload)
     if r.status_code != 200:
-        logger.error(f"failed to authenticate, status code: {r.status_code}, {r.text}")
+        logger.error("failed to authenticate, status code: %s, %s", r.status_code, r.text)
         return None
 
     global auth_token
@@ -423,21 +586,13 @@ def init_websocket() -> Optional[websocket.WebSocketApp]:
     auth_token = response["access_token"]
     expires_in = int(response["expires_in"])
 
-    logger.debug(f"logged in, token: {auth_token}")
-    logger.debug(f"expires in: {expires_in} seconds")
-
-    # rich.print(r.json())
-
-    headers = {
-        "Content-Type": "application/vnd.api+json",
-        "x-api-key": API_KEY,
-        "Authorization": "Bearer " + auth_token
-    }
+    logger.debug("logged in, token: %s", auth_token)
+    logger.debug("expires in: %s seconds", expires_in)
 
     logger.debug("getting locations")
-    r = requests.get(f'{SMART_HOST}/v1/locations', headers=headers)
+    r = http_session.get(f'{SMART_HOST}/v1/locations', headers=JSON_API_HEADERS, auth=smart_auth)
     if r.status_code != 200:
-        logger.error(f"failed to get locations, status code: {r.status_code}, {r.text}")
+        logger.error("failed to get locations, status code: %s, %s", r.status_code, r.text)
         return None
 
     response = r.json()
@@ -446,7 +601,7 @@ def init_websocket() -> Optional[websocket.WebSocketApp]:
         return None
 
     location_id = response["data"][0]["id"]
-    logger.debug(f"location id: {location_id}")
+    logger.debug("location id: %s", location_id)
 
     payload = {
         "data": {
@@ -459,10 +614,10 @@ def init_websocket() -> Optional[websocket.WebSocketApp]:
     }
 
     logger.debug("getting websocket ID")
-    r = requests.post(f'{SMART_HOST}/v1/websocket', json=payload, headers=headers)
+    r = http_session.post(f'{SMART_HOST}/v1/websocket', json=payload, headers=JSON_API_HEADERS, auth=smart_auth)
 
     if r.status_code != 201:
-        logger.error(f"failed to open websocket, status code: {r.status_code}, {r.text}")
+        logger.error("failed to open websocket, status code: %s, %s", r.status_code, r.text)
         return None
 
     logger.debug("websocket ID obtained, connecting")
@@ -470,8 +625,6 @@ def init_websocket() -> Optional[websocket.WebSocketApp]:
     websocket_url = response["data"]["attributes"]["url"]
     websocket.enableTrace(config("TRACE_WEBSOCKET", cast=bool))
 
-    mover = Mover()
-    client = WebSocketClient(mover=mover, broker=mqtt_client)
     ws = websocket.WebSocketApp(
         websocket_url,
         on_message=client.on_message,
@@ -483,18 +636,43 @@ def init_websocket() -> Optional[websocket.WebSocketApp]:
 
 
 def run_websocket():
-    while True:
-        if (ws := init_websocket()) is None:
+    """Runs the websocket until stopped, reconnecting after a pause whenever the connection is lost."""
+    global websocket_app
+
+    reconnect_delay = WEBSOCKET_RECONNECT_DELAY
+    while not stop_event.is_set():
+        client = WebSocketClient(mover=Mover(), broker=mqtt_client)
+        if (websocket_app := init_websocket(client)) is None:
             logger.error("failed to init websocket")
+            reconnect_delay = min(WEBSOCKET_MAX_RECONNECT_DELAY,
+                                  random.uniform(WEBSOCKET_RECONNECT_DELAY, reconnect_delay * MqttClient.RECONNECT_RATE))
+        elif stop_event.is_set():
+            # stopped while the connection was being set up, stop_websocket() had nothing to close then
+            break
+        else:
+            logger.debug("starting websocket main loop")
+            websocket_app.run_forever(ping_interval=150, ping_timeout=1)
+
+            # handle the messages that were still queued when the connection closed
+            client.stop_worker(WORKER_STOP_TIMEOUT)
+
+            logger.debug("websocket main loop done, pausing and reconnecting")
+            reconnect_delay = random.uniform(WEBSOCKET_RECONNECT_DELAY, WEBSOCKET_RECONNECT_DELAY * MqttClient.RECONNECT_RATE)
 
-        logger.debug("starting websocket main loop")
-        ws.run_forever(ping_interval=150, ping_timeout=1)
+        # a stop request ends the pause immediately
+        logger.debug("reconnecting in %.1f seconds", reconnect_delay)
+        stop_event.wait(reconnect_delay)
 
-        logger.debug("websocket main loop done, pausing and reconnecting")
+    logger.info("stopping")
 
-        time.sleep(10)
 
-    # Thread(target=run).start()
+def stop_websocket(signum=None, frame=None):
+    """Stops the websocket loop and closes the current connection. Also used as a signal handler, so this
+    must not log, the log queue lock may already be held by the interrupted main thread."""
+    stop_event.set()
+
+    if (ws := websocket_app) is not None:
+        ws.close()
 
 
 if __name__ == "__main__":
@@ -508,9 +686,10 @@ if __name__ == "__main__":
         logger.error("failed to create MQTT client")
         sys.exit(1)
 
+    signal.signal(signal.SIGTERM, stop_websocket)
+
     run_websocket()
 
-    while True:
-        time.sleep(60)
-        now = datetime.datetime.now()
-        logger.debug("alive")
+    # the websocket loop only ends when stopped
+    mqtt_client.stop()
+    sys.exit(0)